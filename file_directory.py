@@ -7,19 +7,23 @@ base_dir = "D:/dataset_d/mscoco_yolo"
 # Subdirectories containing images
 subdirs = ["images/train2017", "images/val2017", "images/test2017"]
 
+# Image file types to collect (lowercase, without the dot); adjust if needed
+formats = frozenset(('jpg', 'png', 'jpeg'))
+
 for subdir in subdirs:
     full_path = os.path.join(base_dir, subdir)
     output_file = os.path.join(base_dir, f"{subdir.replace('images/', '')}_paths.txt")  # Naming files like train2017_paths.txt
-    
-    relative_paths = []
-    
-    if os.path.exists(full_path):
-        for filename in tqdm(os.listdir(full_path)):
-            if filename.endswith((".jpg", ".png", ".jpeg")):  # Adjust file types if needed
-                relative_paths.append(f"./{subdir}/{filename}")  # Adding `./` for relative paths
 
-    # Save paths to corresponding file
-    with open(output_file, "w") as f:
-        f.write("\n".join(relative_paths))
+    count = 0
+
+    # Stream directory entries straight into the output file (no intermediate list)
+    with open(output_file, "w", buffering=1 << 20) as f:
+        if os.path.exists(full_path):
+            with os.scandir(full_path) as it:
+                for entry in tqdm(it):
+                    # d_type from scandir avoids a stat() call per entry
+                    if entry.is_file(follow_symlinks=False) and entry.name.rpartition('.')[2].lower() in formats:
+                        f.write(f"./{subdir}/{entry.name}\n")  # Adding `./` for relative paths
+                        count += 1
 
-    print(f"Saved {len(relative_paths)} image paths to {output_file}")
+    print(f"Saved {count} image paths to {output_file}")
@@ -1,3 +1,4 @@
+import contextlib
 import copy
 import csv
 import os
@@ -6,6 +7,7 @@ from argparse import ArgumentParser
 from datetime import datetime
 import zipfile
 
+import numpy
 import torch
 import tqdm
 import yaml
@@ -13,7 +15,7 @@ from torch.utils import data
 
 from nets import nn
 from utils import util
-from utils.dataset import Dataset
+from utils.dataset import Dataset, DALILoader
 
 warnings.filterwarnings("ignore")
 
@@ -24,62 +26,85 @@ data_dir = 'D:/dataset_d/mscoco_yolo'
 def train(args, params):
     # Model
     version = args.version
-    if version == 'n':
-        model = nn.yolo_v11_n(len(params['names']))
-    elif version == 's':
-        model = nn.yolo_v11_s(len(params['names']))
-    elif version == 'm':
-        model = nn.yolo_v11_m(len(params['names']))
-    elif version == 'l':
-        model = nn.yolo_v11_l(len(params['names']))
-    elif version == 'x':
-        model = nn.yolo_v11_x(len(params['names']))
-    else:
-        raise ValueError(f"Unsupported YOLOv11 variant: {version}. Choose from 'n', 's', 'm', 'l', 'x'.")
+    model = nn.build_model(version, len(params['names']))
     # model = nn.yolo_v11_m(len(params['names']))
-    model.cuda()
+    device = torch.device('cuda', args.local_rank)
+    model.to(device)
+    model.to(memory_format=torch.channels_last)  # NHWC for Tensor-Core conv kernels
 
     # Optimizer
     accumulate = max(round(64 / (args.batch_size * args.world_size)), 1)
     params['weight_decay'] *= args.batch_size * args.world_size * accumulate / 64
 
     optimizer = torch.optim.SGD(util.set_params(model, params['weight_decay']),
-                                params['min_lr'], params['momentum'], nesterov=True)
+                                params['min_lr'], params['momentum'], nesterov=True, foreach=True)
 
     # EMA
     ema = util.EMA(model) if args.local_rank == 0 else None
-
-    filenames = []
-    with open(f'{data_dir}/train2017.txt') as f:
-        for filename in f.readlines():
-            filename = os.path.basename(filename.rstrip())
-            filenames.append(f'{data_dir}/images/train2017/' + filename)
-            # filenames.append(f'./images/train2017/' + filename)
-        print("filename lists: ", len(filenames))
-
-    # check if file exists
-    existing_count = 0
-    nonexisting_count = 0
-
-    for filepath in filenames:
-        if os.path.exists(filepath):
-            existing_count += 1
+    # FP16 copy of the EMA model used for evaluation, refreshed in place every epoch
+    eval_model = copy.deepcopy(ema.ema).half().eval() if args.local_rank == 0 else None
+
+    # resolved filenames are cached next to the list, rebuilt when the list changes
+    list_file = f'{data_dir}/train2017.txt'
+    cache_file = f'{data_dir}/train2017_cache.npy'
+
+    def read_list():
+        with open(list_file) as f:
+            return [f'{data_dir}/images/train2017/' + os.path.basename(filename)
+                    for filename in f.read().splitlines()]
+
+    def cache_valid():
+        return os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(list_file)
+
+    filenames = None
+    if args.local_rank == 0 and not cache_valid():
+        filenames = read_list()
+        try:
+            numpy.save(cache_file, numpy.array(filenames))  # fixed-width unicode, no pickle
+        except OSError as e:
+            # e.g. a read-only dataset mount, keep the list in memory
+            print(f"Could not write filename cache {cache_file}: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(cache_file)  # do not leave a partial cache behind
+    if args.distributed:
+        torch.distributed.barrier()  # wait for rank 0 to build the cache
+    if filenames is None:
+        if cache_valid():
+            filenames = numpy.load(cache_file, mmap_mode='r').tolist()
         else:
-            nonexisting_count += 1
+            filenames = read_list()
+    print("filename lists: ", len(filenames))
 
-    print(f"Number of existing files: {existing_count}")
+    # check if file exists, one directory scan instead of a stat() per file
+    with os.scandir(f'{data_dir}/images/train2017') as it:
+        present = {e.name for e in it if e.is_file()}
+    existing = [f for f in filenames if os.path.basename(f) in present]
+    nonexisting_count = len(filenames) - len(existing)
+
+    print(f"Number of existing files: {len(existing)}")
     print(f"Number of non-existing files: {nonexisting_count}")
+    if not existing:
+        raise FileNotFoundError(f"None of the {len(filenames)} files listed in {list_file} "
+                                f"exist in {data_dir}/images/train2017")
 
     sampler = None
-    dataset = Dataset(filenames, args.input_size, params, augment=True)
-    # dataset = Dataset(filenames, args.input_size, params, augment=True, data_dir=data_dir)
+    if args.dali:
+        # GPU decode and augmentation, sharding is handled by the DALI reader
+        shard_id = torch.distributed.get_rank() if args.distributed else 0
+        loader = DALILoader(existing, args.input_size, params, args.batch_size,
+                            device_id=args.local_rank, shard_id=shard_id, num_shards=args.world_size)
+    else:
+        dataset = Dataset(existing, args.input_size, params, augment=True)
+        # dataset = Dataset(filenames, args.input_size, params, augment=True, data_dir=data_dir)
 
-    if args.distributed:
-        sampler = data.distributed.DistributedSampler(dataset)
-    
-    # loading data
-    loader = data.DataLoader(dataset, args.batch_size, sampler is None, sampler,
-                             num_workers=8, pin_memory=True, collate_fn=Dataset.collate_fn)
+        if args.distributed:
+            sampler = data.distributed.DistributedSampler(dataset)
+
+        # loading data
+        num_workers = min(os.cpu_count() or 8, 16)
+        loader = data.DataLoader(dataset, args.batch_size, sampler is None, sampler,
+                                 num_workers=num_workers, pin_memory=True, persistent_workers=True,
+                                 prefetch_factor=4, collate_fn=Dataset.collate_fn)
 
     # Scheduler
     num_steps = len(loader)
@@ -95,6 +120,15 @@ def train(args, params):
                                                           device_ids=[args.local_rank],
                                                           output_device=args.local_rank)
 
+    # `network` is the (compiled) callable used for the forward pass, `model` (the DDP wrapper in
+    # DDP mode) is kept for no_sync, EMA and the loss, which unwrap `.module` themselves
+    network = model
+    if args.compile and hasattr(torch, 'compile'):
+        network = torch.compile(model, mode='max-autotune', fullgraph=False, dynamic=False)
+
+    # loss scaled by batch_size, gradient averaged between devices in DDP mode
+    loss_scale = float(args.batch_size * args.world_size)
+
     best = 0
     amp_scale = torch.amp.GradScaler()
     criterion = util.ComputeLoss(model, params)
@@ -106,26 +140,27 @@ def train(args, params):
     # Write file
     with open(csv_file, 'w', newline='') as log:
         if args.local_rank == 0:
-            logger = csv.DictWriter(log, fieldnames=['epoch',
-                                                     'box', 'cls', 'dfl',
-                                                     'Recall', 'Precision', 'mAP@50', 'mAP'])
-            logger.writeheader()
+            log.write('epoch,box,cls,dfl,Recall,Precision,mAP@50,mAP\n')
 
 
         for epoch in range(args.epochs):
             model.train()
-            if args.distributed:
+            if sampler is not None:
                 sampler.set_epoch(epoch)
-            if args.epochs - epoch == 10:
+            if args.epochs - epoch == 10 and not args.dali:
                 loader.dataset.mosaic = False
+                # persistent workers hold their own copy of the dataset, restart them
+                loader = data.DataLoader(dataset, args.batch_size, sampler is None, sampler,
+                                         num_workers=num_workers, pin_memory=True, persistent_workers=True,
+                                         prefetch_factor=4, collate_fn=Dataset.collate_fn)
 
-            p_bar = enumerate(loader)
+            p_bar = enumerate(util.Prefetcher(loader, device))
 
             if args.local_rank == 0:
                 print(('\n' + '%10s' * 5) % ('epoch', 'memory', 'box', 'cls', 'dfl'))
                 p_bar = tqdm.tqdm(p_bar, total=num_steps)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             avg_box_loss = util.AverageMeter()
             avg_cls_loss = util.AverageMeter()
             avg_dfl_loss = util.AverageMeter()
@@ -134,26 +169,26 @@ def train(args, params):
                 step = i + num_steps * epoch
                 scheduler.step(step, optimizer)
 
-                samples = samples.cuda().float() / 255
+                # Skip the DDP gradient all-reduce until the accumulation boundary
+                if args.distributed and step % accumulate != 0:
+                    sync_context = model.no_sync
+                else:
+                    sync_context = contextlib.nullcontext
 
-                # Forward
-                with torch.amp.autocast('cuda'):
-                    outputs = model(samples)  # forward
-                    loss_box, loss_cls, loss_dfl = criterion(outputs, targets)
+                with sync_context():
+                    # Forward
+                    with torch.amp.autocast('cuda'):
+                        outputs = network(samples)  # forward
+                        loss_box, loss_cls, loss_dfl = criterion(outputs, targets)
 
-                avg_box_loss.update(loss_box.item(), samples.size(0))
-                avg_cls_loss.update(loss_cls.item(), samples.size(0))
-                avg_dfl_loss.update(loss_dfl.item(), samples.size(0))
+                    avg_box_loss.update(loss_box, samples.size(0))
+                    avg_cls_loss.update(loss_cls, samples.size(0))
+                    avg_dfl_loss.update(loss_dfl, samples.size(0))
 
-                loss_box *= args.batch_size  # loss scaled by batch_size
-                loss_cls *= args.batch_size  # loss scaled by batch_size
-                loss_dfl *= args.batch_size  # loss scaled by batch_size
-                loss_box *= args.world_size  # gradient averaged between devices in DDP mode
-                loss_cls *= args.world_size  # gradient averaged between devices in DDP mode
-                loss_dfl *= args.world_size  # gradient averaged between devices in DDP mode
+                    total_loss = (loss_box + loss_cls + loss_dfl).mul_(loss_scale)
 
-                # Backward
-                amp_scale.scale(loss_box + loss_cls + loss_dfl).backward()
+                    # Backward
+                    amp_scale.scale(total_loss).backward()
 
                 # Optimize
                 if step % accumulate == 0:
@@ -161,14 +196,12 @@ def train(args, params):
                     # util.clip_gradients(model)  # clip gradients
                     amp_scale.step(optimizer)  # optimizer.step
                     amp_scale.update()
-                    optimizer.zero_grad()
+                    optimizer.zero_grad(set_to_none=True)
                     if ema:
                         ema.update(model)
 
-                torch.cuda.synchronize()
-
-                # Log
-                if args.local_rank == 0:
+                # Log, reading the averages forces a host sync so only refresh periodically
+                if args.local_rank == 0 and (i % 50 == 0 or i == num_steps - 1):
                     memory = f'{torch.cuda.memory_reserved() / 1E9:.4g}G'  # (GB)
                     s = ('%10s' * 2 + '%10.3g' * 3) % (f'{epoch + 1}/{args.epochs}', memory,
                                                        avg_box_loss.avg, avg_cls_loss.avg, avg_dfl_loss.avg)
@@ -176,20 +209,19 @@ def train(args, params):
 
             if args.local_rank == 0:
                 # mAP
-                last = test(args, params, ema.ema)
+                eval_model.load_state_dict(ema.ema.state_dict())
+                last = test(args, params, eval_model)
                 current_mAP = last[0]  # mAP computed from test()
                 mAP_list.append(current_mAP)
                 epoch_list.append(epoch + 1)
 
-                logger.writerow({'epoch': str(epoch + 1).zfill(3),
-                                 'box': str(f'{avg_box_loss.avg:.3f}'),
-                                 'cls': str(f'{avg_cls_loss.avg:.3f}'),
-                                 'dfl': str(f'{avg_dfl_loss.avg:.3f}'),
-                                 'mAP': str(f'{last[0]:.3f}'),
-                                 'mAP@50': str(f'{last[1]:.3f}'),
-                                 'Recall': str(f'{last[2]:.3f}'),
-                                 'Precision': str(f'{last[3]:.3f}')})
-                log.flush()
+                log.write(f'{epoch + 1:03d},'
+                          f'{avg_box_loss.avg:.3f},{avg_cls_loss.avg:.3f},{avg_dfl_loss.avg:.3f},'
+                          f'{last[2]:.3f},{last[3]:.3f},{last[1]:.3f},{last[0]:.3f}\n')
+                if (epoch + 1) % 10 == 0 or epoch + 1 == args.epochs:
+                    log.flush()
+                    # Plot mAP
+                    plot_mAP(args)
 
                 # Update best mAP
                 # if last[0] > best:
@@ -197,19 +229,24 @@ def train(args, params):
                 if current_mAP > best:
                     best = current_mAP
 
-                # Save model
-                save = {'epoch': epoch + 1,
-                        'model': copy.deepcopy(ema.ema),
-                        # 'model': copy.deepcopy(ema.ema).state_dict()
-                        }
-                # print(save['model'])
-
-                # Save last, best and delete
-                torch.save(save, f=f'./weights/last_{version}_{args.epochs}.pt')
-                # if best == last[0]:
-                if best == current_mAP:
-                    torch.save(save, f=f'./weights/best_{version}_{args.epochs}.pt')
-                del save
+                # Save model, `last` only every 5 epochs, on a new best and at the end
+                is_best = best == current_mAP
+                if is_best or (epoch + 1) % 5 == 0 or epoch + 1 == args.epochs:
+                    save = {'epoch': epoch + 1,
+                            # 'model': copy.deepcopy(ema.ema),
+                            'model': {k: v.detach().cpu().half() if v.dtype.is_floating_point else v.detach().cpu()
+                                      for k, v in ema.ema.state_dict().items()}
+                            }
+                    # print(save['model'])
+
+                    # Save last, best and delete
+                    torch.save(save, f=f'./weights/last_{version}_{args.epochs}.pt',
+                               pickle_protocol=5, _use_new_zipfile_serialization=True)
+                    # if best == last[0]:
+                    if is_best:
+                        torch.save(save, f=f'./weights/best_{version}_{args.epochs}.pt',
+                                   pickle_protocol=5, _use_new_zipfile_serialization=True)
+                    del save
 
     if args.local_rank == 0:
         # Finalize logging and close file.
@@ -235,6 +272,8 @@ def plot_mAP(args):
     
     # Plot mAP vs. epochs using Matplotlib
     import matplotlib.pyplot as plt
+    plt.rcParams['path.simplify'] = True
+    plt.rcParams['path.simplify_threshold'] = 1.0
     # plt.figure()
     # # plt.plot(epoch_list, mAP_list, marker='o', label='mAP')
     # plt.plot(epoch_list, mAP_list, label=f'mAP (last: {last_mAP:.3f}, best: {best_mAP:.3f})')
@@ -267,8 +306,8 @@ def plot_mAP(args):
     # ax.legend(loc="upper center", bbox_to_anchor=(0.5, 1.15), ncol=2, frameon=False)
     fig.legend(loc="outside lower center")
 
-    plt.savefig(f"./weights/mAP_vs_epochs_{args.version}_{args.epochs}.png")
-    plt.close()
+    fig.savefig(f"./weights/mAP_vs_epochs_{args.version}_{args.epochs}.png")
+    plt.close(fig)
 
 @torch.no_grad()
 def test(args, params, model=None):
@@ -283,21 +322,39 @@ def test(args, params, model=None):
 
     dataset = Dataset(filenames, args.input_size, params, augment=False)
     # dataset = Dataset(filenames, args.input_size, params, augment=False, data_dir=data_dir)
-    loader = data.DataLoader(dataset, batch_size=4, shuffle=False, num_workers=4,
+    # inference only, no gradient memory so a larger batch fits
+    # built on every call, so workers are not kept alive and use the default prefetch
+    loader = data.DataLoader(dataset, batch_size=max(args.batch_size, 16), shuffle=False, num_workers=8,
                              pin_memory=True, collate_fn=Dataset.collate_fn)
 
+    device = torch.device('cuda', args.local_rank)
     plot = False
     if not model:
         plot = True
-        model = torch.load(f=f'./weights/best_{version}_{args.epochs}.pt', map_location='cuda')
-        model = model['model'].float().fuse()
+        ckpt = torch.load(f=f'./weights/best_{version}_{args.epochs}.pt', map_location=device)
+        if isinstance(ckpt['model'], torch.nn.Module):  # checkpoints saved before the state_dict format
+            model = ckpt['model'].float()
+        else:
+            model = nn.build_model(version, len(params['names']))
+            model.load_state_dict(ckpt['model'])
+        model = model.to(device).fuse()
 
     model.half()
     model.eval()
+    model.to(memory_format=torch.channels_last)
+    if plot and args.compile and hasattr(torch, 'compile'):
+        # only for standalone evaluation, recompiling the EMA model every epoch costs more than it saves
+        model = torch.compile(model, mode='max-autotune', fullgraph=False, dynamic=False)
 
     # Configure
-    iou_v = torch.linspace(start=0.5, end=0.95, steps=10).cuda()  # iou vector for mAP@0.5:0.95
+    iou_v = torch.linspace(start=0.5, end=0.95, steps=10, device=device)  # iou vector for mAP@0.5:0.95
     n_iou = iou_v.numel()
+    zero_pad = torch.zeros(0, device=device)  # conf/cls placeholder for images without detections
+    # all-false metric rows for images without targets, sliced per image and never written to
+    max_det = 300  # maximum detections per image kept by NMS
+    no_match = torch.zeros(max_det, n_iou, dtype=torch.bool, device=device)
+    # inputs are letterboxed to a square of input_size
+    scale = torch.tensor((args.input_size,) * 4, device=device)
 
     m_pre = 0
     m_rec = 0
@@ -306,39 +363,36 @@ def test(args, params, model=None):
     metrics = []
     p_bar = tqdm.tqdm(loader, desc=('%10s' * 5) % ('', 'precision', 'recall', 'mAP50', 'mAP'))
     for samples, targets in p_bar:
-        samples = samples.cuda()
+        samples = samples.to(device, non_blocking=True)
         samples = samples.half()  # uint8 to fp16/32
-        samples = samples / 255.  # 0 - 255 to 0.0 - 1.0
-        _, _, h, w = samples.shape  # batch-size, channels, height, width
-        scale = torch.tensor((w, h, w, h)).cuda()
+        samples = samples.contiguous(memory_format=torch.channels_last)
+        samples = samples.mul_(1 / 255.)  # 0 - 255 to 0.0 - 1.0
         # Inference
         outputs = model(samples)
         # NMS
-        outputs = util.non_max_suppression(outputs)
+        outputs = util.non_max_suppression(outputs, max_det=max_det)
         # Metrics
+        # copy targets once per batch, boxes converted to pixel (x1, y1, x2, y2) up front
+        cls_all = targets['cls'].to(device, non_blocking=True)
+        box_all = util.wh2xy(targets['box'].to(device, non_blocking=True)).mul_(scale)
+        idx_all = targets['idx'].to(device, non_blocking=True)
         for i, output in enumerate(outputs):
-            idx = targets['idx'] == i
-            cls = targets['cls'][idx]
-            box = targets['box'][idx]
+            idx = idx_all == i
+            cls = cls_all[idx]
+            box = box_all[idx]
 
-            cls = cls.cuda()
-            box = box.cuda()
-
-            metric = torch.zeros(output.shape[0], n_iou, dtype=torch.bool).cuda()
+            metric = no_match[:output.shape[0]]
 
             if output.shape[0] == 0:
                 if cls.shape[0]:
-                    metrics.append((metric, *torch.zeros((2, 0)).cuda(), cls.squeeze(-1)))
+                    metrics.append((metric, zero_pad, zero_pad, cls.squeeze(-1)))
                 continue
             # Evaluate
             if cls.shape[0]:
-                target = torch.cat(tensors=(cls, util.wh2xy(box) * scale), dim=1)
+                target = torch.cat(tensors=(cls, box), dim=1)
                 metric = util.compute_metric(output[:, :6], target, iou_v)
             # Append
             metrics.append((metric, output[:, 4], output[:, 5], cls.squeeze(-1)))
-    
-    # Computer mAP
-    plot_mAP(args)
 
     # Compute metrics
     metrics = [torch.cat(x, dim=0).cpu().numpy() for x in zip(*metrics)]  # to numpy
@@ -347,7 +401,6 @@ def test(args, params, model=None):
     # Print results
     print(('%10s' + '%10.3g' * 4) % ('', m_pre, m_rec, map50, mean_ap))
     # Return results
-    model.float()  # for training
     return mean_ap, map50, m_rec, m_pre
 
 
@@ -389,9 +442,13 @@ def zip_weights_directory(args):
 
     # Create ZIP file
     output_zip = f"result_{args.version}_{args.epochs}.zip"
-    with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
+    with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
         for file in files_to_zip:
-            zipf.write(file, os.path.basename(file))
+            if file.endswith((".pt", ".pth")):
+                # torch weights barely compress, store them as is
+                zipf.write(file, os.path.basename(file), compress_type=zipfile.ZIP_STORED)
+            else:
+                zipf.write(file, os.path.basename(file))
 
     print(f"Successfully created {output_zip} containing {len(files_to_zip)} files.")
 
@@ -409,6 +466,8 @@ def main():
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--version', default='m', type=str)
     parser.add_argument('--zip', action='store_true')
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--dali', action='store_true')
 
     args = parser.parse_args()
     print(args)
@@ -345,3 +345,18 @@ def yolo_v11_x(num_classes: int = 80):
     depth = [2, 2, 2, 2, 2, 2]
     width = [3, 96, 192, 384, 768, 768]
     return YOLO(width, depth, csp, num_classes)
+
+
+def build_model(version, num_classes):
+    if version == 'n':
+        return yolo_v11_n(num_classes)
+    elif version == 's':
+        return yolo_v11_s(num_classes)
+    elif version == 'm':
+        return yolo_v11_m(num_classes)
+    elif version == 'l':
+        return yolo_v11_l(num_classes)
+    elif version == 'x':
+        return yolo_v11_x(num_classes)
+    else:
+        raise ValueError(f"Unsupported YOLOv11 variant: {version}. Choose from 'n', 's', 'm', 'l', 'x'.")
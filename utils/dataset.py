@@ -308,6 +308,84 @@ class Dataset(data.Dataset):
         return x
 
 
+class DALILoader:
+    """
+    Training loader on top of NVIDIA DALI (https://github.com/NVIDIA/DALI), optional dependency
+    Decodes JPEGs with nvJPEG, letterboxes and flips on the GPU,
+    mosaic, mix-up, HSV and perspective augmentations of `Dataset` are not applied
+    """
+    def __init__(self, filenames, input_size, params, batch_size, device_id=0, shard_id=0, num_shards=1):
+        from nvidia.dali import fn, pipeline_def, types
+        from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+
+        # Read labels
+        labels = Dataset.load_label(filenames)
+        self.labels = list(labels.values())
+        self.filenames = list(labels.keys())
+        self.input_size = input_size
+
+        @pipeline_def
+        def pipeline():
+            # reader label is the sample index, boxes are looked up on the host
+            images, indices = fn.readers.file(files=self.filenames,
+                                              labels=list(range(len(self.filenames))),
+                                              shard_id=shard_id, num_shards=num_shards,
+                                              random_shuffle=True, name='Reader')
+            shapes = fn.peek_image_shape(images)  # original (h, w, c) to adjust boxes
+            images = fn.decoders.image(images, device='mixed', output_type=types.RGB)
+            # letterbox as in `resize`: keep aspect ratio, pad to a centered square
+            images = fn.resize(images, resize_x=input_size, resize_y=input_size, mode='not_larger')
+            images = fn.crop(images, crop=(input_size, input_size),
+                             out_of_bounds_policy='pad', fill_values=0)
+            flip = fn.random.coin_flip(probability=params['flip_lr'])
+            images = fn.flip(images, horizontal=flip)
+            images = fn.transpose(images, perm=[2, 0, 1])  # HWC to CHW
+            return images, shapes, flip, indices
+
+        # deeper prefetch queues hurt when preprocessing time varies
+        pipe = pipeline(batch_size=batch_size, num_threads=4, device_id=device_id, prefetch_queue_depth=2)
+        pipe.build()
+        self.iterator = DALIGenericIterator(pipe, ['images', 'shape', 'flip', 'idx'],
+                                            reader_name='Reader', auto_reset=True,
+                                            last_batch_policy=LastBatchPolicy.DROP)
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        for x in self.iterator:
+            x = x[0]
+            cls = []
+            box = []
+            indices = []
+            shapes = x['shape'].tolist()
+            flips = x['flip'].view(-1).tolist()
+            for i, index in enumerate(x['idx'].view(-1).tolist()):
+                label = torch.from_numpy(self.labels[index])
+                h, w = shapes[i][:2]
+                r = self.input_size / max(h, w)
+                # fraction of the letterboxed image covered by the resized one
+                fw = round(w * r) / self.input_size
+                fh = round(h * r) / self.input_size
+
+                target_box = label[:, 1:5].clone()
+                target_box[:, 0] = target_box[:, 0] * fw + (1 - fw) / 2
+                target_box[:, 1] = target_box[:, 1] * fh + (1 - fh) / 2
+                target_box[:, 2] *= fw
+                target_box[:, 3] *= fh
+                if flips[i]:
+                    target_box[:, 0] = 1 - target_box[:, 0]
+
+                cls.append(label[:, 0:1])
+                box.append(target_box)
+                indices.append(torch.full((len(label),), i, dtype=torch.float))
+
+            targets = {'cls': torch.cat(cls, dim=0),
+                       'box': torch.cat(box, dim=0),
+                       'idx': torch.cat(indices, dim=0)}
+            yield x['images'], targets
+
+
 def wh2xy(x, w=640, h=640, pad_w=0, pad_h=0):
     # Convert nx4 boxes
     # from [x, y, w, h] normalized to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
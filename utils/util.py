@@ -17,8 +17,9 @@ def setup_seed():
     random.seed(0)
     numpy.random.seed(0)
     torch.manual_seed(0)
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    # input size is fixed, let cuDNN benchmark and pick the fastest (possibly non-deterministic) kernels
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
 
 
 def setup_multi_processes():
@@ -33,6 +34,9 @@ def setup_multi_processes():
     if system() != 'Windows':
         torch.multiprocessing.set_start_method('fork', force=True)
 
+    # share tensors through files, persistent workers would otherwise exhaust the fd limit
+    torch.multiprocessing.set_sharing_strategy('file_system')
+
     # disable opencv multithreading to avoid system being overloaded
     cv2.setNumThreads(0)
 
@@ -45,14 +49,16 @@ def setup_multi_processes():
         environ['MKL_NUM_THREADS'] = '1'
 
 
-def export_onnx(args):
+def export_onnx(args, params):
     import onnx  # noqa
+    from nets import nn
 
     inputs = ['images']
     outputs = ['outputs']
     dynamic = {'outputs': {0: 'batch', 1: 'anchors'}}
 
-    m = torch.load('./weights/best.pt')['model'].float()
+    m = nn.build_model(args.version, len(params['names']))
+    m.load_state_dict(torch.load('./weights/best.pt', map_location='cpu')['model'])
     x = torch.zeros((1, 3, args.input_size, args.input_size))
 
     torch.onnx.export(m.cpu(), x.cpu(),
@@ -121,9 +127,8 @@ def compute_metric(output, target, iou_v):
     return torch.tensor(correct, dtype=torch.bool, device=output.device)
 
 
-def non_max_suppression(outputs, confidence_threshold=0.001, iou_threshold=0.65):
+def non_max_suppression(outputs, confidence_threshold=0.001, iou_threshold=0.65, max_det=300):
     max_wh = 7680
-    max_det = 300
     max_nms = 30000
 
     bs = outputs.shape[0]  # batch size
@@ -337,11 +342,9 @@ def compute_iou(box1, box2, eps=1e-7):
 def strip_optimizer(filename):
     print(f"entering util.strip_optimizer for: {filename}")
     x = torch.load(filename, map_location="cpu")
-    x['model'].half()  # to FP16
-    for p in x['model'].parameters():
-        p.requires_grad = False
+    # x['model'] is already an FP16 state_dict
     # torch.save(x['model'], f=f"{filename}.pt")
-    torch.save(x['model'].state_dict(), f=f"./weights/{pathlib.Path(filename).stem}_state_dict.pt")
+    torch.save(x['model'], f=f"./weights/{pathlib.Path(filename).stem}_state_dict.pt")
 
 
 def clip_gradients(model, max_norm=10.0):
@@ -352,12 +355,14 @@ def clip_gradients(model, max_norm=10.0):
 def load_weight(model, ckpt):
     print('entering util.load_weights')
     dst = model.state_dict()
-    src = torch.load(ckpt)['model'].float().cpu()
+    src = torch.load(ckpt, map_location='cpu')['model']
+    if isinstance(src, torch.nn.Module):  # checkpoints of the original repository
+        src = src.state_dict()
 
     ckpt = {}
-    for k, v in src.state_dict().items():
+    for k, v in src.items():
         if k in dst and v.shape == dst[k].shape:
-            ckpt[k] = v
+            ckpt[k] = v.float() if v.dtype.is_floating_point else v
 
     model.load_state_dict(state_dict=ckpt, strict=False)
     return model
@@ -470,23 +475,81 @@ class EMA:
             d = self.decay(self.updates)
 
             msd = model.state_dict()  # model state_dict
+            ema_v = []
+            model_v = []
             for k, v in self.ema.state_dict().items():
                 if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1 - d) * msd[k].detach()
+                    ema_v.append(v)
+                    model_v.append(msd[k].detach())
+            # multi-tensor update, a few kernel launches instead of two per tensor
+            torch._foreach_mul_(ema_v, d)
+            torch._foreach_add_(ema_v, model_v, alpha=1 - d)
 
 
 class AverageMeter:
     def __init__(self):
         self.num = 0
         self.sum = 0
-        self.avg = 0
 
     def update(self, v, n):
-        if not math.isnan(float(v)):
+        if isinstance(v, torch.Tensor):
+            # accumulate on the device, NaN values are masked out without a host sync
+            v = v.detach()
+            valid = ~v.isnan()
+            self.num = self.num + valid * n
+            self.sum = self.sum + v.masked_fill(~valid, 0) * n
+        elif not math.isnan(float(v)):
             self.num = self.num + n
             self.sum = self.sum + v * n
-            self.avg = self.sum / self.num
+
+    @property
+    def avg(self):
+        if isinstance(self.num, torch.Tensor):
+            return (self.sum / self.num.clamp(min=1)).item()
+        return self.sum / self.num if self.num else 0
+
+
+class Prefetcher:
+    """
+    CUDA data prefetcher adapted from https://github.com/NVIDIA/apex
+    Copies and normalizes the next batch on a side stream to overlap H2D transfer with compute
+    """
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.preload()
+
+    def preload(self):
+        try:
+            samples, targets = next(self.loader)
+        except StopIteration:
+            self.next_samples = None
+            self.next_targets = None
+            return
+        # batches already on the GPU (e.g. from DALI) may still be written on the current stream
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            samples = samples.to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+            # uint8 to fp16 (AMP-native), in-place multiply by reciprocal avoids an fp32 copy
+            self.next_samples = samples.half().mul_(1 / 255.)
+            self.next_targets = {k: v.to(self.device, non_blocking=True) for k, v in targets.items()}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        samples = self.next_samples
+        targets = self.next_targets
+        if samples is None:
+            raise StopIteration
+        # tensors were allocated on the side stream, keep them alive for the current one
+        samples.record_stream(torch.cuda.current_stream())
+        for v in targets.values():
+            v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return samples, targets
 
 
 class Assigner(torch.nn.Module):